@@ -1,16 +1,16 @@
 """
 GET  /api/data          → returns all Transactions + Inventory + Pending as JSON
-POST /api/data          → adds a new transaction from the HTML app
+POST /api/data          → adds a new transaction (or a list of them) from the HTML app
 """
 
 from http.server import BaseHTTPRequestHandler
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+import orjson
 import requests
+from requests.adapters import HTTPAdapter, Retry
 import hashlib
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 
 # ── ENV ────────────────────────────────────────────────────────────────────────
 GOOGLE_SERVICE_ACCOUNT_JSON = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
@@ -18,6 +18,9 @@ SPREADSHEET_ID              = os.environ.get("SPREADSHEET_ID")
 TELEGRAM_BOT_TOKEN          = os.environ.get("TELEGRAM_BOT_TOKEN")
 API_SECRET_KEY              = os.environ.get("API_SECRET_KEY")  # Set this in Vercel env vars
 
+SHEETS_TIMEOUT = 20  # seconds per Sheets API call
+TG_MAX_TEXT    = 4000  # Telegram rejects messages over 4096 characters
+
 # Allowed origins for CORS (add your Vercel domain here too if needed)
 ALLOWED_ORIGINS = ["*"]
 
@@ -28,26 +31,54 @@ S_INVENTORY    = "Inventory"
 S_PENDING      = "Pending"
 
 # ── SHEETS ─────────────────────────────────────────────────────────────────────
+_CREDS = None
+
+def sheets_creds():
+    # Kept for the life of the warm process so the access token is reused until it expires.
+    global _CREDS
+    if _CREDS is None:
+        # Imported here so CORS preflights and rejected requests skip the Google client stack.
+        from google.oauth2.service_account import Credentials
+
+        _CREDS = Credentials.from_service_account_info(
+            orjson.loads(GOOGLE_SERVICE_ACCOUNT_JSON),
+            scopes=["https://www.googleapis.com/auth/spreadsheets"],
+        )
+    return _CREDS
+
+_SVC = None
+
 def sheets_svc():
-    creds = Credentials.from_service_account_info(
-        json.loads(GOOGLE_SERVICE_ACCOUNT_JSON),
-        scopes=["https://www.googleapis.com/auth/spreadsheets"],
-    )
-    return build("sheets", "v4", credentials=creds)
-
-def read_sheet(svc, sheet, rng="A1:Z"):
-    res = svc.spreadsheets().values().get(
+    global _SVC
+    if _SVC is None:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build
+
+        # One authorized keep-alive connection for the life of the process, with a bounded timeout.
+        http = AuthorizedHttp(sheets_creds(), http=httplib2.Http(timeout=SHEETS_TIMEOUT))
+        _SVC = build(
+            "sheets", "v4",
+            http=http,
+            cache_discovery=False,
+            static_discovery=True,
+        )
+    return _SVC
+
+def read_ranges(svc, ranges):
+    res = svc.spreadsheets().values().batchGet(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"{sheet}!{rng}",
+        ranges=ranges,
     ).execute()
-    return res.get("values", [])
+    return [vr.get("values", []) for vr in res.get("valueRanges", [])]
 
-def append_row(svc, sheet, row: list):
+def append_rows(svc, sheet, rows: list):
     svc.spreadsheets().values().append(
         spreadsheetId=SPREADSHEET_ID,
         range=f"{sheet}!A1",
         valueInputOption="USER_ENTERED",
-        body={"values": [row]},
+        insertDataOption="INSERT_ROWS",
+        body={"values": rows},
     ).execute()
 
 # ── UTILS ──────────────────────────────────────────────────────────────────────
@@ -55,11 +86,14 @@ def now_str():
     return datetime.now(UAE_TZ).strftime("%Y-%m-%d %H:%M")
 
 def fmt(x):
+    if isinstance(x, int):
+        return x
     try:
-        f = float(x)
-        return int(f) if f.is_integer() else round(f, 2)
-    except Exception:
+        f = round(float(x), 2)
+        i = int(f)
+    except (TypeError, ValueError, OverflowError):
         return 0
+    return i if i == f else f
 
 def rows_to_dicts(rows):
     if not rows:
@@ -114,6 +148,15 @@ def parse_inventory(rows):
             continue
     return out
 
+def summarize(transactions):
+    income = expense = 0
+    for x in transactions:
+        if x["type"] == "دخل":
+            income += x["amount"]
+        elif x["type"] == "صرف":
+            expense += x["amount"]
+    return {"income": income, "expense": expense, "profit": income - expense}
+
 # ── CORS HEADERS ───────────────────────────────────────────────────────────────
 CORS_HEADERS = {
     "Access-Control-Allow-Origin":  "*",
@@ -122,6 +165,13 @@ CORS_HEADERS = {
     "Content-Type": "application/json",
 }
 
+# ── TELEGRAM ───────────────────────────────────────────────────────────────────
+TG_SESSION = requests.Session()
+# Retry only failed connects: a POST that reached Telegram must not be sent twice.
+TG_RETRY   = Retry(total=1, connect=1, read=0, status=0, backoff_factor=0.1)
+TG_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=TG_RETRY))
+TG_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
 # ── HANDLER ────────────────────────────────────────────────────────────────────
 class handler(BaseHTTPRequestHandler):
 
@@ -134,7 +184,7 @@ class handler(BaseHTTPRequestHandler):
         return self.headers.get("X-API-Key", "") == API_SECRET_KEY
 
     def _send(self, code, body: dict):
-        payload = json.dumps(body, ensure_ascii=False).encode()
+        payload = orjson.dumps(body)
         self.send_response(code)
         for k, v in CORS_HEADERS.items():
             self.send_header(k, v)
@@ -154,21 +204,17 @@ class handler(BaseHTTPRequestHandler):
             return
         try:
             svc = sheets_svc()
-            t_rows = read_sheet(svc, S_TRANSACTIONS, "A1:F")
-            i_rows = read_sheet(svc, S_INVENTORY,    "A1:D")
+            t_rows, i_rows = read_ranges(svc, [
+                f"{S_TRANSACTIONS}!A1:F",
+                f"{S_INVENTORY}!A1:D",
+            ])
             transactions = parse_transactions(t_rows)
             inventory    = parse_inventory(i_rows)
-            income  = sum(x["amount"] for x in transactions if x["type"] == "دخل")
-            expense = sum(x["amount"] for x in transactions if x["type"] == "صرف")
             self._send(200, {
                 "ok": True,
                 "transactions": transactions,
                 "inventory":    inventory,
-                "summary": {
-                    "income":  income,
-                    "expense": expense,
-                    "profit":  income - expense,
-                },
+                "summary":      summarize(transactions),
             })
         except Exception as e:
             self._send(500, {"ok": False, "error": str(e)})
@@ -179,35 +225,67 @@ class handler(BaseHTTPRequestHandler):
             return
         try:
             length = int(self.headers.get("Content-Length", 0))
-            body   = json.loads(self.rfile.read(length).decode())
-            kind     = body.get("type", "")
-            item     = body.get("item", "")
-            category = body.get("category") or item
-            amount   = body.get("amount", 0)
-            user     = body.get("user", "App")
-            if not kind or not item or not amount:
+            body   = orjson.loads(self.rfile.read(length))
+            now    = now_str()
+            rows   = []
+            for entry in (body if isinstance(body, list) else [body]):
+                if not isinstance(entry, dict):
+                    self._send(400, {"ok": False, "error": "each transaction must be an object"})
+                    return
+                kind     = entry.get("type", "")
+                item     = entry.get("item", "")
+                category = entry.get("category") or item
+                amount   = entry.get("amount", 0)
+                user     = entry.get("user", "App")
+                if not kind or not item or not amount:
+                    self._send(400, {"ok": False, "error": "type, item, amount required"})
+                    return
+                rows.append([now, kind, item, category, amount, user])
+            if not rows:
                 self._send(400, {"ok": False, "error": "type, item, amount required"})
                 return
             svc = sheets_svc()
-            append_row(svc, S_TRANSACTIONS, [now_str(), kind, item, category, amount, user])
-            _notify_telegram(kind, item, amount, user)
+            append_rows(svc, S_TRANSACTIONS, rows)
+            _notify_telegram(rows)
             self._send(200, {"ok": True, "message": "تم التسجيل"})
         except Exception as e:
             self._send(500, {"ok": False, "error": str(e)})
 
 
-def _notify_telegram(kind, item, amount, user):
+def _notify_telegram(rows):
     if not TELEGRAM_BOT_TOKEN:
         return
     allowed_chat_ids = [47329648, 6894180427]
-    emoji = "💰" if kind == "دخل" else "📤"
-    text  = f"{emoji} [من التطبيق]\n{kind}: {item}\nالمبلغ: {amount} د.إ\nبواسطة: {user}"
-    for chat_id in allowed_chat_ids:
-        try:
-            requests.post(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                json={"chat_id": chat_id, "text": text},
-                timeout=5,
-            )
-        except Exception:
-            pass
+    blocks = []
+    for _, kind, item, _, amount, user in rows:
+        emoji = "💰" if kind == "دخل" else "📤"
+        blocks.append(f"{emoji} [من التطبيق]\n{kind}: {item}\nالمبلغ: {amount} د.إ\nبواسطة: {user}")
+    texts = _pack_messages(blocks)
+    # One sequence per chat; run the chats side by side, keeping order within each.
+    list(TG_EXECUTOR.map(lambda chat_id: [_send_telegram(chat_id, t) for t in texts], allowed_chat_ids))
+
+
+def _pack_messages(blocks):
+    # Join blocks into as few messages as fit under Telegram's 4096-character limit.
+    texts = []
+    for block in blocks:
+        while len(block) > TG_MAX_TEXT:
+            texts.append(block[:TG_MAX_TEXT])
+            block = block[TG_MAX_TEXT:]
+        if texts and len(texts[-1]) + 2 + len(block) <= TG_MAX_TEXT:
+            texts[-1] += "\n\n" + block
+        else:
+            texts.append(block)
+    return texts
+
+
+def _send_telegram(chat_id, text):
+    try:
+        TG_SESSION.post(
+            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+            data=orjson.dumps({"chat_id": chat_id, "text": text}),
+            headers={"Content-Type": "application/json"},
+            timeout=5,
+        )
+    except requests.RequestException:
+        pass
@@ -1,18 +1,29 @@
 # api/telegram-webhook.py
 
 from http.server import BaseHTTPRequestHandler
-import json
+import hmac
 import os
 import re
+import time
+from bisect import bisect_left
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+from operator import itemgetter
+import orjson
 import requests
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from requests.adapters import HTTPAdapter, Retry
 
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GOOGLE_SERVICE_ACCOUNT_JSON = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID")
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")  # secret_token passed to setWebhook
+
+MAX_UPDATE_BYTES = 64 * 1024
+MAX_SEEN_UPDATES = 4096
+TX_CACHE_MAX_AGE = 300  # after this, reload fully even if the row-count sentinel matches
+SHEETS_TIMEOUT = 20  # seconds per Sheets API call
+TG_MAX_TEXT = 4000  # Telegram rejects messages over 4096 characters
+TG_TIMEOUT = (3, 10)  # connect, read seconds for Telegram calls
 
 ALLOWED_USERS = {
     47329648: "Khaled",
@@ -67,111 +78,334 @@ REPORT_MENU = [
 CONFIRM_MENU = [["✅ تأكيد", "❌ إلغاء"]]
 SKIP_MENU = [["➡️ تخطي", "❌ إلغاء"]]
 
+# Fixed expenses and the report category they are booked under, whichever way they are entered.
+FIXED_EXPENSES = {
+    "فاتورة كهرباء": "كهرباء",
+    "عمالة": "رواتب",
+}
 
-def now_str():
-    return datetime.now(UAE_TZ).strftime("%Y-%m-%d %H:%M")
+MENU_ACTIONS = {
+    "بيع": "sale",
+    "شراء": "purchase",
+    "فاتورة كهرباء": "electricity",
+    "عمالة": "labor",
+    "الجرد": "inventory",
+    "التقرير": "report",
+    "آخر العمليات": "last",
+    "تراجع آخر عملية": "undo",
+}
 
+LABEL_PREFIX_RE = re.compile(r"^[^\w\u0600-\u06FF]+\s*")
+NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+UPDATED_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+QUICK_ENTRY_RE = re.compile(r"^(\S+)\s+(?:([\d٠-٩]+)\s+)?(.+?)\s+([\d٠-٩][\d٠-٩.,]*)$")
+DIGIT_RE = re.compile(r"[\d٠-٩]")
+# Whole words only, with an optional article or "ها"/"هال" prefix, so "عليكم" or "كمية" never match.
+# "كم" alone is not a report question ("كم بيض عندنا" asks about stock), so it needs a money verb.
+REPORT_WORDS_RE = re.compile(
+    r"(?<!\w)(?:(?:ال)?(?:تقرير|ربح|صافي|مبيعات|مصاريف|مصروف|دخل)"
+    r"|كم\s+(?:صرفنا|صرفت|بعنا|بعت|دخلنا|دخل|كسبنا|كسبت|ربحنا))(?!\w)"
+)
+STOCK_WORDS_RE = re.compile(r"(?<!\w)(?:عندنا|عندي|باقي|بقى|(?:ال)?جرد|(?:ال)?مخزون)(?!\w)")
+PERIOD_RE = re.compile(r"(?<!\w)(?:ال|هال|ها)?(يوم|أسبوع|اسبوع|شهر)(?!\w)")
+PERIOD_WORDS = {
+    "يوم": "today",
+    "أسبوع": "week",
+    "اسبوع": "week",
+    "شهر": "month",
+}
+QUICK_VERBS = {
+    "بعت": "sale",
+    "بعنا": "sale",
+    "بيع": "sale",
+    "اشتريت": "purchase",
+    "اشترينا": "purchase",
+    "شراء": "purchase",
+    "دفعت": "purchase",
+    "صرفت": "purchase",
+}
 
-def today_str():
-    return datetime.now(UAE_TZ).strftime("%Y-%m-%d")
+
+def now_str():
+    return datetime.now(UAE_TZ).strftime("%Y-%m-%d %H:%M")
 
 
 def fmt(x):
+    if isinstance(x, int):
+        return str(x)
     try:
-        f = float(x)
-        return str(int(f)) if f.is_integer() else str(round(f, 2))
-    except Exception:
+        f = round(float(x), 2)
+        i = int(f)
+    except (TypeError, ValueError, OverflowError):
         return str(x)
+    return str(i) if i == f else str(f)
+
+
+def signed(ttype, amount):
+    return f"{'+' if ttype == 'دخل' else '-'}{fmt(amount)}"
 
 
 def clean_label(text):
     text = (text or "").strip()
-    text = re.sub(r"^[^\w\u0600-\u06FF]+\s*", "", text)
+    text = LABEL_PREFIX_RE.sub("", text)
     return text.strip()
 
 
 def normalize_amount(text):
     if not text:
         return 0.0
-    arabic_digits = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
-    cleaned = text.translate(arabic_digits)
+    cleaned = text.translate(ARABIC_DIGITS)
     cleaned = cleaned.replace(",", "")
-    match = re.search(r"-?\d+(?:\.\d+)?", cleaned)
+    match = NUMBER_RE.search(cleaned)
     return float(match.group(0)) if match else 0.0
 
 
+def parse_number(cell):
+    text = str(cell).replace(",", "").strip()
+    return float(text) if NUMBER_RE.fullmatch(text) else None
+
+
 def normalize_qty(text):
     amount = normalize_amount(text)
     return int(amount) if amount > 0 else 0
 
 
-def send(chat_id, text, keyboard=None, remove_keyboard=False):
-    if not TELEGRAM_BOT_TOKEN:
-        return
-    payload = {"chat_id": chat_id, "text": text}
+TG_SESSION = requests.Session()
+# Retry only failed connects: a POST that reached Telegram must not be sent twice.
+TG_RETRY = Retry(total=1, connect=1, read=0, status=0, backoff_factor=0.1)
+TG_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=TG_RETRY))
+
+
+def chunks(text, limit=TG_MAX_TEXT):
+    # Split on line boundaries so long inventories and reports stay readable.
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        yield text[:cut]
+        text = text[cut:].lstrip("\n")
+    yield text
+
+
+def message_payloads(chat_id, text, keyboard=None, remove_keyboard=False):
+    markup = None
     if keyboard:
-        payload["reply_markup"] = {
+        markup = {
             "keyboard": keyboard,
             "resize_keyboard": True,
             "one_time_keyboard": False,
         }
     elif remove_keyboard:
-        payload["reply_markup"] = {"remove_keyboard": True}
+        markup = {"remove_keyboard": True}
+    parts = list(chunks(text))
+    payloads = []
+    for i, part in enumerate(parts, start=1):
+        payload = {"chat_id": chat_id, "text": part}
+        if markup and i == len(parts):
+            payload["reply_markup"] = markup
+        payloads.append(payload)
+    return payloads
+
+
+def post_messages(payloads):
     try:
-        requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-            json=payload,
-            timeout=15,
-        )
-    except Exception:
+        for payload in payloads:
+            TG_SESSION.post(
+                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+                data=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=TG_TIMEOUT,
+            )
+    except requests.RequestException:
         pass
 
 
+_OUTBOX = None  # replies held back while the webhook handles an update
+
+
+def hold_replies():
+    global _OUTBOX
+    _OUTBOX = []
+
+
+def take_replies():
+    global _OUTBOX
+    payloads, _OUTBOX = _OUTBOX or [], None
+    return payloads
+
+
+def send(chat_id, text, keyboard=None, remove_keyboard=False):
+    if not TELEGRAM_BOT_TOKEN:
+        return
+    payloads = message_payloads(chat_id, text, keyboard, remove_keyboard)
+    if _OUTBOX is not None:
+        _OUTBOX.extend(payloads)
+        return
+    post_messages(payloads)
+
+
+_SEEN_UPDATES = OrderedDict()
+
+
+def seen_update(update_id):
+    if update_id is None:
+        return False
+    if update_id in _SEEN_UPDATES:
+        return True
+    _SEEN_UPDATES[update_id] = True
+    while len(_SEEN_UPDATES) > MAX_SEEN_UPDATES:
+        _SEEN_UPDATES.popitem(last=False)
+    return False
+
+
+_CREDS = None
+
+
+def sheets_creds():
+    # Kept for the life of the warm process so the access token is reused until it expires.
+    global _CREDS
+    if _CREDS is None:
+        # Imported here so GET pings and rejected updates skip the Google client stack.
+        from google.oauth2.service_account import Credentials
+
+        info = orjson.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+        _CREDS = Credentials.from_service_account_info(
+            info,
+            scopes=["https://www.googleapis.com/auth/spreadsheets"],
+        )
+    return _CREDS
+
+
+_SVC = None
+
+
 def sheets_svc():
-    info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-    creds = Credentials.from_service_account_info(
-        info,
-        scopes=["https://www.googleapis.com/auth/spreadsheets"],
-    )
-    return build("sheets", "v4", credentials=creds)
+    global _SVC
+    if _SVC is None:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build
+
+        # One authorized keep-alive connection for the life of the process, with a bounded timeout.
+        http = AuthorizedHttp(sheets_creds(), http=httplib2.Http(timeout=SHEETS_TIMEOUT))
+        _SVC = build(
+            "sheets", "v4",
+            http=http,
+            cache_discovery=False,
+            static_discovery=True,
+        )
+    return _SVC
 
 
-def read_sheet(svc, sheet, rng="A1:Z"):
+_PREFETCHED = {}
+
+
+def prefetch(svc, ranges):
+    # One values.batchGet for reads this update is about to make; read_sheet() consumes each once.
+    try:
+        res = svc.spreadsheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=ranges,
+        ).execute()
+    except Exception:
+        return
+    for rng, vr in zip(ranges, res.get("valueRanges", [])):
+        _PREFETCHED[rng] = vr.get("values", [])
+
+
+def fetch_sheet(svc, sheet, rng="A1:Z"):
+    # None when the read failed, so callers that cache can tell it apart from an empty range.
+    key = f"{sheet}!{rng}"
+    if key in _PREFETCHED:
+        return _PREFETCHED.pop(key)
     try:
         res = svc.spreadsheets().values().get(
             spreadsheetId=SPREADSHEET_ID,
-            range=f"{sheet}!{rng}",
+            range=key,
         ).execute()
         return res.get("values", [])
     except Exception:
-        return []
+        return None
+
 
+def read_sheet(svc, sheet, rng="A1:Z"):
+    rows = fetch_sheet(svc, sheet, rng)
+    return rows if rows is not None else []
 
-def append_row(svc, sheet, row):
-    ensure_sheet(svc, sheet)
-    svc.spreadsheets().values().append(
+
+def appended_row(res):
+    match = UPDATED_ROW_RE.search(res.get("updates", {}).get("updatedRange", ""))
+    return int(match.group(1)) if match else None
+
+
+SHEETS_EPOCH = datetime(1899, 12, 30)
+DATE_TIME_FORMAT = {"numberFormat": {"type": "DATE_TIME", "pattern": "yyyy-mm-dd hh:mm"}}
+
+
+def cell(value):
+    if isinstance(value, datetime):
+        serial = (value.replace(tzinfo=None, second=0, microsecond=0) - SHEETS_EPOCH) / timedelta(days=1)
+        return {"userEnteredValue": {"numberValue": serial}, "userEnteredFormat": DATE_TIME_FORMAT}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def append_cells(svc, rows_by_sheet, extra=()):
+    # One spreadsheets.batchUpdate for appends that would otherwise be one values.append each.
+    batch = list(extra)
+    for sheet, rows in rows_by_sheet.items():
+        batch.append({"appendCells": {
+            "sheetId": ensure_sheet(svc, sheet),
+            "rows": [{"values": [cell(v) for v in row]} for row in rows],
+            "fields": "userEnteredValue,userEnteredFormat.numberFormat",
+        }})
+    svc.spreadsheets().batchUpdate(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"{sheet}!A1",
-        valueInputOption="USER_ENTERED",
-        body={"values": [row]},
+        body={"requests": batch},
     ).execute()
 
 
+_SHEET_IDS = {}
+
+
+def load_sheet_ids(svc):
+    meta = svc.spreadsheets().get(
+        spreadsheetId=SPREADSHEET_ID,
+        fields="sheets.properties(sheetId,title)",
+    ).execute()
+    for sheet in meta.get("sheets", []):
+        _SHEET_IDS[sheet["properties"]["title"]] = sheet["properties"]["sheetId"]
+
+
 def ensure_sheet(svc, sheet_name):
+    # The sheet's id, or None when Sheets could not be reached to look it up or create it.
+    if sheet_name in _SHEET_IDS:
+        return _SHEET_IDS[sheet_name]
     try:
-        meta = svc.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-        sheets = [s["properties"]["title"] for s in meta.get("sheets", [])]
-        if sheet_name in sheets:
-            return
-        svc.spreadsheets().batchUpdate(
+        load_sheet_ids(svc)
+        if sheet_name in _SHEET_IDS:
+            return _SHEET_IDS[sheet_name]
+        res = svc.spreadsheets().batchUpdate(
             spreadsheetId=SPREADSHEET_ID,
             body={"requests": [{"addSheet": {"properties": {"title": sheet_name}}}]},
         ).execute()
+        props = res["replies"][0]["addSheet"]["properties"]
+        _SHEET_IDS[props["title"]] = props["sheetId"]
     except Exception:
         pass
+    return _SHEET_IDS.get(sheet_name)
+
+
+_STATE_READY = False
+_STATE_ROWS = {}  # user_id -> BotState row number; the bot only ever appends to that sheet
 
 
 def ensure_state_sheet(svc):
+    global _STATE_READY
+    if _STATE_READY:
+        return
     ensure_sheet(svc, S_STATE)
     rows = read_sheet(svc, S_STATE, "A1:C1")
     if not rows:
@@ -181,84 +415,144 @@ def ensure_state_sheet(svc):
             valueInputOption="USER_ENTERED",
             body={"values": [["User_ID", "State_JSON", "Updated_At"]]},
         ).execute()
+    _STATE_READY = True
 
 
 def get_state(svc, user_id):
     ensure_state_sheet(svc)
     rows = read_sheet(svc, S_STATE, "A2:C")
-    for r in rows:
+    for i, r in enumerate(rows, start=2):
         if r and r[0] == str(user_id):
+            _STATE_ROWS[user_id] = i
             try:
-                return json.loads(r[1]) if len(r) > 1 and r[1] else {}
-            except Exception:
+                return orjson.loads(r[1]) if len(r) > 1 and r[1] else {}
+            except orjson.JSONDecodeError:
                 return {}
     return {}
 
 
 def set_state(svc, user_id, state):
     ensure_state_sheet(svc)
-    rows = read_sheet(svc, S_STATE, "A2:C")
-    body = [[str(user_id), json.dumps(state, ensure_ascii=False), now_str()]]
-    for i, r in enumerate(rows, start=2):
-        if r and r[0] == str(user_id):
-            svc.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{S_STATE}!A{i}:C{i}",
-                valueInputOption="USER_ENTERED",
-                body={"values": body},
-            ).execute()
-            return
-    svc.spreadsheets().values().append(
+    body = [[str(user_id), orjson.dumps(state).decode(), now_str()]]
+    row = _STATE_ROWS.get(user_id)
+    if row is None:
+        rows = read_sheet(svc, S_STATE, "A2:C")
+        row = next((i for i, r in enumerate(rows, start=2) if r and r[0] == str(user_id)), None)
+    if row is not None:
+        svc.spreadsheets().values().update(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"{S_STATE}!A{row}:C{row}",
+            valueInputOption="USER_ENTERED",
+            body={"values": body},
+        ).execute()
+        _STATE_ROWS[user_id] = row
+        return
+    res = svc.spreadsheets().values().append(
         spreadsheetId=SPREADSHEET_ID,
         range=f"{S_STATE}!A1",
         valueInputOption="USER_ENTERED",
+        insertDataOption="INSERT_ROWS",
         body={"values": body},
     ).execute()
+    row = appended_row(res)
+    if row:
+        _STATE_ROWS[user_id] = row
+
+
+def advance(svc, user_id, chat_id, state, text, keyboard):
+    # State first: a button must never be tappable before the step behind it is saved,
+    # and a failed write must not leave a prompt the bot cannot route.
+    set_state(svc, user_id, state)
+    send(chat_id, text, keyboard)
+
+
+def finish(svc, user_id, chat_id, text):
+    advance(svc, user_id, chat_id, {}, text, MAIN_MENU)
 
 
-def clear_state(svc, user_id):
-    set_state(svc, user_id, {})
+def transaction_row(at, ttype, item, category, amount, user):
+    return [at, ttype, item, category, amount, user]
 
 
-def add_transaction(svc, ttype, item, category, amount, user):
-    append_row(svc, S_TRANSACTIONS, [now_str(), ttype, item, category, amount, user])
+def pending_row(at, user_id, op_type, action, item, amount, qty, person, notes=""):
+    return [str(user_id), at, op_type, action, item, amount, qty, person, notes]
 
 
-def add_pending(svc, user_id, op_type, action, item, amount, qty, person, notes=""):
-    append_row(svc, S_PENDING, [str(user_id), now_str(), op_type, action, item, amount, qty, person, notes])
+_TX_CACHE = {"loaded_at": 0.0, "rows": None, "sig": None, "tail": None}
 
 
-def load_transactions(svc):
-    rows = read_sheet(svc, S_TRANSACTIONS, "A2:Z")
+def sheet_signature(rows):
+    return len(rows), rows[-1][0] if rows and rows[-1] else ""
+
+
+def invalidate_transactions():
+    _TX_CACHE["rows"] = None
+
+
+def transaction_record(row, date, ttype, item, category, amount, user):
+    return {
+        "row": row,
+        "date": date,
+        "type": ttype,
+        "item": item,
+        "category": category,
+        "amount": amount,
+        "user": user,
+        # Derived once per load so cached reports don't recompute them per row.
+        "signed": amount if ttype == "دخل" else -amount,
+        "bucket": category or item or "غير محدد",
+    }
+
+
+def parse_transactions(rows, start=2):
     out = []
-    for i, r in enumerate(rows, start=2):
+    for i, r in enumerate(rows, start=start):
         if len(r) < 5:
             continue
-        try:
-            amount = float(str(r[4]).replace(",", ""))
-        except Exception:
+        amount = parse_number(r[4])
+        if amount is None:
             continue
-        out.append({
-            "row": i,
-            "date": r[0],
-            "type": r[1],
-            "item": r[2],
-            "category": r[3] if len(r) > 3 else "",
-            "amount": amount,
-            "user": r[5] if len(r) > 5 else "",
-        })
+        out.append(transaction_record(i, r[0], r[1], r[2], r[3], amount, r[5] if len(r) > 5 else ""))
+    return out
+
+
+def load_transactions(svc, fresh=False):
+    cached = _TX_CACHE["rows"]
+    now = time.monotonic()
+    if cached is not None and not fresh and now - _TX_CACHE["loaded_at"] < TX_CACHE_MAX_AGE:
+        # Every read checks column A first; it alone tells whether rows were added or
+        # removed since the last parse, by this instance or any other.
+        column = read_sheet(svc, S_TRANSACTIONS, "A2:A")
+        if sheet_signature(column) == _TX_CACHE["sig"]:
+            return cached
+        count = _TX_CACHE["sig"][0]
+        if count and len(column) > count:
+            # Re-read the old last row along with anything after it. If it is unchanged,
+            # rows were only appended and just those need parsing.
+            tail = fetch_sheet(svc, S_TRANSACTIONS, f"A{count + 1}:F")
+            if tail is None:
+                return cached
+            if tail and tail[0] == _TX_CACHE["tail"]:
+                out = cached + parse_transactions(tail[1:], count + 2)
+                sig = (count - 1 + len(tail), tail[-1][0] if tail[-1] else "")
+                _TX_CACHE.update(rows=out, sig=sig, tail=tail[-1])
+                return out
+    rows = fetch_sheet(svc, S_TRANSACTIONS, "A2:F")
+    if rows is None:
+        # Never cache a failed read. Serve the previous copy unless the caller needs fresh rows.
+        return cached if cached is not None and not fresh else []
+    out = parse_transactions(rows)
+    _TX_CACHE.update(loaded_at=now, rows=out, sig=sheet_signature(rows), tail=rows[-1] if rows else None)
     return out
 
 
 def delete_transaction_row(svc, row_num):
-    meta = svc.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-    sheet_id = None
-    for sheet in meta.get("sheets", []):
-        if sheet["properties"]["title"] == S_TRANSACTIONS:
-            sheet_id = sheet["properties"]["sheetId"]
-            break
+    if S_TRANSACTIONS not in _SHEET_IDS:
+        load_sheet_ids(svc)
+    sheet_id = _SHEET_IDS.get(S_TRANSACTIONS)
     if sheet_id is None:
         return False
+    invalidate_transactions()
     svc.spreadsheets().batchUpdate(
         spreadsheetId=SPREADSHEET_ID,
         body={"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": row_num - 1, "endIndex": row_num}}}]},
@@ -280,32 +574,28 @@ def find_inventory_row(rows, item_name):
     return -1
 
 
-def update_inventory(svc, item_name, qty_delta, item_type="", notes=""):
-    ensure_sheet(svc, S_INVENTORY)
+def inventory_request(svc, item_name, qty_delta, item_type="", notes=""):
+    # Returns the batchUpdate request that applies qty_delta, so it can ride along with the save.
+    sheet_id = ensure_sheet(svc, S_INVENTORY)
     rows = read_sheet(svc, S_INVENTORY, "A2:D")
-    values_api = svc.spreadsheets().values()
     i = find_inventory_row(rows, item_name)
     if i >= 0:
         r = rows[i]
-        old_qty = int(float(r[2])) if len(r) > 2 and r[2] else 0
+        old_qty = int(parse_number(r[2]) or 0) if len(r) > 2 else 0
         new_qty = max(0, old_qty + int(qty_delta))
-        row_num = i + 2
-        values_api.update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{S_INVENTORY}!A{row_num}:D{row_num}",
-            valueInputOption="USER_ENTERED",
-            body={"values": [[r[0], r[1] if len(r) > 1 else item_type, new_qty, r[3] if len(r) > 3 else notes]]},
-        ).execute()
-        return new_qty
+        values = [r[0], r[1] if len(r) > 1 else item_type, new_qty, r[3] if len(r) > 3 else notes]
+        return {"updateCells": {
+            "range": {"sheetId": sheet_id, "startRowIndex": i + 1, "endRowIndex": i + 2, "startColumnIndex": 0, "endColumnIndex": 4},
+            "rows": [{"values": [cell(v) for v in values]}],
+            "fields": "userEnteredValue",
+        }}
     if qty_delta > 0:
-        values_api.append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{S_INVENTORY}!A1:D1",
-            valueInputOption="USER_ENTERED",
-            body={"values": [[item_name, item_type, int(qty_delta), notes]]},
-        ).execute()
-        return int(qty_delta)
-    return 0
+        return {"appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [cell(v) for v in [item_name, item_type, int(qty_delta), notes]]}],
+            "fields": "userEnteredValue",
+        }}
+    return None
 
 
 def load_inventory(svc):
@@ -314,46 +604,52 @@ def load_inventory(svc):
     for r in rows:
         if not r or not r[0]:
             continue
-        try:
-            qty = int(float(r[2])) if len(r) > 2 and r[2] else 0
-        except Exception:
-            qty = 0
+        qty = int(parse_number(r[2]) or 0) if len(r) > 2 else 0
         out.append({"item": r[0], "type": r[1] if len(r) > 1 else "", "qty": qty, "notes": r[3] if len(r) > 3 else ""})
     return out
 
 
-def filter_by_period(data, period):
-    now = datetime.now(UAE_TZ)
+def period_bounds(period, today):
     if period == "today":
-        key = now.strftime("%Y-%m-%d")
-        return [x for x in data if x["date"].startswith(key)], "اليوم"
+        return today, today + timedelta(days=1), "اليوم"
     if period == "week":
-        start = (now - timedelta(days=6)).date()
-        out = []
-        for x in data:
-            try:
-                d = datetime.strptime(x["date"][:10], "%Y-%m-%d").date()
-            except Exception:
-                continue
-            if start <= d <= now.date():
-                out.append(x)
-        return out, "آخر ٧ أيام"
+        return today - timedelta(days=6), today + timedelta(days=1), "آخر ٧ أيام"
+    start = today.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1), "هذا الشهر"
+
+
+def by_date(data):
+    # "YYYY-MM-DD HH:MM" strings sort chronologically. The sorted view is kept next to
+    # the cached list it was built from, so warm reports sort once per sheet load.
+    view = _TX_CACHE.get("by_date")
+    if view is None or view[0] is not data:
+        ordered = sorted(data, key=itemgetter("date"))
+        view = (data, ordered, [x["date"] for x in ordered])
+        _TX_CACHE["by_date"] = view
+    return view[1], view[2]
+
+
+def filter_by_period(data, period):
     if period == "all":
         return data, "كل الفترة"
-    key = now.strftime("%Y-%m")
-    return [x for x in data if x["date"].startswith(key)], "هذا الشهر"
+    start, end, label = period_bounds(period, datetime.now(UAE_TZ).date())
+    ordered, keys = by_date(data)
+    lo = bisect_left(keys, start.isoformat())
+    hi = bisect_left(keys, end.isoformat(), lo)
+    return ordered[lo:hi], label
 
 
 def report_text(svc, period):
     data, label = filter_by_period(load_transactions(svc), period)
-    income = sum(x["amount"] for x in data if x["type"] == "دخل")
-    expense = sum(x["amount"] for x in data if x["type"] == "صرف")
-    net = income - expense
+    income = expense = 0
     by_category = {}
     for x in data:
-        key = x["category"] or x["item"] or "غير محدد"
-        signed = x["amount"] if x["type"] == "دخل" else -x["amount"]
-        by_category[key] = by_category.get(key, 0) + signed
+        if x["type"] == "دخل":
+            income += x["amount"]
+        elif x["type"] == "صرف":
+            expense += x["amount"]
+        by_category[x["bucket"]] = by_category.get(x["bucket"], 0) + x["signed"]
+    net = income - expense
     lines = [D, f"📊 التقرير - {label}", f"الدخل: +{fmt(income)} درهم", f"المصروف: -{fmt(expense)} درهم", f"الصافي: {fmt(net)} درهم", D]
     if by_category:
         lines.append("حسب البند:")
@@ -369,49 +665,42 @@ def menu_text():
 
 
 def start_sale(svc, user_id, chat_id):
-    set_state(svc, user_id, {"flow": "sale", "step": "item", "data": {"type": "دخل"}})
-    send(chat_id, "💰 بيع\nاختر الشي اللي بعته:", SELL_ITEMS)
+    advance(svc, user_id, chat_id, {"flow": "sale", "step": "item", "data": {"type": "دخل"}}, "💰 بيع\nاختر الشي اللي بعته:", SELL_ITEMS)
 
 
 def start_purchase(svc, user_id, chat_id):
-    set_state(svc, user_id, {"flow": "purchase", "step": "item", "data": {"type": "صرف"}})
-    send(chat_id, "🛒 شراء\nاختر الشي اللي اشتريته:", BUY_ITEMS)
+    advance(svc, user_id, chat_id, {"flow": "purchase", "step": "item", "data": {"type": "صرف"}}, "🛒 شراء\nاختر الشي اللي اشتريته:", BUY_ITEMS)
 
 
-def start_fixed_expense(svc, user_id, chat_id, item, category):
-    set_state(svc, user_id, {"flow": "expense", "step": "amount", "data": {"type": "صرف", "item": item, "category": category, "qty": 1}})
-    send(chat_id, f"{item}\nاكتب المبلغ:", [["❌ إلغاء"]])
+def start_fixed_expense(svc, user_id, chat_id, item):
+    state = {"flow": "expense", "step": "amount", "data": {"type": "صرف", "item": item, "category": FIXED_EXPENSES[item], "qty": 1}}
+    advance(svc, user_id, chat_id, state, f"{item}\nاكتب المبلغ:", [["❌ إلغاء"]])
 
 
 def ask_quantity(svc, user_id, chat_id, state):
-    set_state(svc, user_id, state)
-    send(chat_id, f"اكتب الكمية لـ {state['data']['item']}:", [["❌ إلغاء"]])
+    advance(svc, user_id, chat_id, state, f"اكتب الكمية لـ {state['data']['item']}:", [["❌ إلغاء"]])
 
 
 def ask_amount(svc, user_id, chat_id, state):
-    set_state(svc, user_id, state)
-    send(chat_id, "اكتب المبلغ الإجمالي بالدرهم:", [["❌ إلغاء"]])
+    advance(svc, user_id, chat_id, state, "اكتب المبلغ الإجمالي بالدرهم:", [["❌ إلغاء"]])
 
 
 def ask_payment(svc, user_id, chat_id, state):
-    set_state(svc, user_id, state)
-    send(chat_id, "اختر طريقة الدفع:", PAYMENT_METHODS)
+    advance(svc, user_id, chat_id, state, "اختر طريقة الدفع:", PAYMENT_METHODS)
 
 
 def ask_notes(svc, user_id, chat_id, state):
-    set_state(svc, user_id, state)
-    send(chat_id, "اكتب ملاحظة اختيارية أو اضغط تخطي:", SKIP_MENU)
+    advance(svc, user_id, chat_id, state, "اكتب ملاحظة اختيارية أو اضغط تخطي:", SKIP_MENU)
 
 
 def confirmation_text(data):
-    sign = "+" if data.get("type") == "دخل" else "-"
     lines = [
         D,
         "تأكيد العملية؟",
         f"النوع: {data.get('type')}",
         f"البند: {data.get('item')}",
         f"الكمية: {data.get('qty', 1)}",
-        f"المبلغ: {sign}{fmt(data.get('amount', 0))} درهم",
+        f"المبلغ: {signed(data.get('type'), data.get('amount', 0))} درهم",
         f"الدفع: {data.get('payment_method', '-')}",
         f"الملاحظة: {data.get('notes') or '-'}",
         D,
@@ -421,8 +710,7 @@ def confirmation_text(data):
 
 def ask_confirm(svc, user_id, chat_id, state):
     state["step"] = "confirm"
-    set_state(svc, user_id, state)
-    send(chat_id, confirmation_text(state["data"]), CONFIRM_MENU)
+    advance(svc, user_id, chat_id, state, confirmation_text(state["data"]), CONFIRM_MENU)
 
 
 def item_type_for_inventory(item):
@@ -449,29 +737,87 @@ def save_flow(svc, user_id, chat_id, user_name, state):
     payment = data.get("payment_method") or ""
     notes = data.get("notes") or ""
     full_item = item
-    if qty > 1 and item not in {"فاتورة كهرباء", "عمالة"}:
+    if qty > 1 and item not in FIXED_EXPENSES:
         full_item = f"{item} × {qty}"
     if payment or notes:
         extra = " | ".join([x for x in [payment, notes] if x])
         full_item = f"{full_item} ({extra})"
-    add_transaction(svc, ttype, full_item, category, amount, user_name)
-    add_pending(svc, user_id, "transaction", state.get("flow", "menu"), item, amount, qty, user_name, notes)
+    sheets = [S_TRANSACTIONS, S_PENDING] + ([S_INVENTORY] if should_update_inventory(item) else [])
+    if any(ensure_sheet(svc, sheet) is None for sheet in sheets):
+        # Keep the confirm step so the user can retry once Sheets answers again.
+        send(chat_id, "⚠️ ما تم التسجيل: تعذر الوصول لـ Google Sheets.\nاضغط تأكيد مرة ثانية.", CONFIRM_MENU)
+        return
+    extra = []
     if should_update_inventory(item):
         delta = qty if ttype == "صرف" else -qty
-        update_inventory(svc, item, delta, item_type_for_inventory(item), notes)
-    clear_state(svc, user_id)
-    sign = "+" if ttype == "دخل" else "-"
-    send(chat_id, f"{D}\n✅ تم التسجيل\nالبند: {item}\nالكمية: {qty}\nالمبلغ: {sign}{fmt(amount)} درهم\n{D}", MAIN_MENU)
+        change = inventory_request(svc, item, delta, item_type_for_inventory(item), notes)
+        if change:
+            extra.append(change)
+    now = datetime.now(UAE_TZ)
+    append_cells(svc, {
+        S_TRANSACTIONS: [transaction_row(now, ttype, full_item, category, amount, user_name)],
+        S_PENDING: [pending_row(now, user_id, "transaction", state.get("flow", "menu"), item, amount, qty, user_name, notes)],
+    }, extra)
+    finish(svc, user_id, chat_id, f"{D}\n✅ تم التسجيل\nالبند: {item}\nالكمية: {qty}\nالمبلغ: {signed(ttype, amount)} درهم\n{D}")
+
+
+def quick_entry(text):
+    # "بعت 5 بيض 250" goes straight to confirmation instead of walking every step.
+    match = QUICK_ENTRY_RE.match(text)
+    if not match or match.group(1) not in QUICK_VERBS:
+        return None
+    item = clean_label(match.group(3))
+    amount = normalize_amount(match.group(4))
+    if not item or DIGIT_RE.search(item) or amount <= 0:
+        return None
+    qty = normalize_qty(match.group(2)) if match.group(2) else 0
+    if match.group(2) and not qty:
+        return None
+    flow = QUICK_VERBS[match.group(1)]
+    ttype = "دخل" if flow == "sale" else "صرف"
+    data = {"type": ttype, "item": item, "category": FIXED_EXPENSES.get(item, item), "amount": amount}
+    if qty:
+        data["qty"] = qty
+    elif not should_update_inventory(item):
+        data["qty"] = 1
+    else:
+        # A stock item needs a real count, so ask for it before confirming.
+        return {"flow": flow, "step": "quantity", "data": data}
+    return {"flow": flow, "step": "confirm", "data": data}
+
+
+def report_period(text):
+    # "كم صرفنا اليوم" and similar questions map straight to a report period.
+    if not REPORT_WORDS_RE.search(text):
+        return None
+    match = PERIOD_RE.search(text)
+    return PERIOD_WORDS[match.group(1)] if match else "all"
+
+
+def handle_free_text(svc, user_id, chat_id, text):
+    state = quick_entry(text)
+    if state and state["step"] == "quantity":
+        ask_quantity(svc, user_id, chat_id, state)
+        return
+    if state:
+        ask_confirm(svc, user_id, chat_id, state)
+        return
+    period = report_period(text)
+    if period:
+        send(chat_id, report_text(svc, period), MAIN_MENU)
+        return
+    if STOCK_WORDS_RE.search(text):
+        send_inventory(svc, chat_id)
+        return
+    send(chat_id, menu_text(), MAIN_MENU)
 
 
 def handle_flow(svc, user_id, chat_id, user_name, text, state):
     if text in CANCEL_WORDS:
-        clear_state(svc, user_id)
-        send(chat_id, "تم إلغاء العملية.", MAIN_MENU)
+        finish(svc, user_id, chat_id, "تم إلغاء العملية.")
         return
     if text in BACK_WORDS:
-        clear_state(svc, user_id)
-        send(chat_id, menu_text(), MAIN_MENU)
+        finish(svc, user_id, chat_id, menu_text())
         return
     step = state.get("step")
     data = state.setdefault("data", {})
@@ -481,8 +827,7 @@ def handle_flow(svc, user_id, chat_id, user_name, text, state):
         item = clean_label(text)
         if item == "أخرى":
             state["step"] = "custom_item"
-            set_state(svc, user_id, state)
-            send(chat_id, "اكتب اسم البند:", [["❌ إلغاء"]])
+            advance(svc, user_id, chat_id, state, "اكتب اسم البند:", [["❌ إلغاء"]])
             return
         data["item"] = item
         data["category"] = item
@@ -507,6 +852,10 @@ def handle_flow(svc, user_id, chat_id, user_name, text, state):
             send(chat_id, "اكتب الكمية رقم فقط. مثال: 12", [["❌ إلغاء"]])
             return
         data["qty"] = qty
+        if data.get("amount"):
+            # A one-line entry already gave the amount; only the count was missing.
+            ask_confirm(svc, user_id, chat_id, state)
+            return
         state["step"] = "amount"
         ask_amount(svc, user_id, chat_id, state)
         return
@@ -536,12 +885,10 @@ def handle_flow(svc, user_id, chat_id, user_name, text, state):
         if text in CONFIRM_WORDS:
             save_flow(svc, user_id, chat_id, user_name, state)
             return
-        clear_state(svc, user_id)
-        send(chat_id, "تم إلغاء العملية.", MAIN_MENU)
+        finish(svc, user_id, chat_id, "تم إلغاء العملية.")
         return
 
-    clear_state(svc, user_id)
-    send(chat_id, menu_text(), MAIN_MENU)
+    finish(svc, user_id, chat_id, menu_text())
 
 
 def handle_report_choice(svc, user_id, chat_id, text):
@@ -553,11 +900,9 @@ def handle_report_choice(svc, user_id, chat_id, text):
     }
     period = mapping.get(text)
     if not period:
-        set_state(svc, user_id, {"flow": "report", "step": "choose", "data": {}})
-        send(chat_id, "اختر نوع التقرير:", REPORT_MENU)
+        advance(svc, user_id, chat_id, {"flow": "report", "step": "choose", "data": {}}, "اختر نوع التقرير:", REPORT_MENU)
         return
-    clear_state(svc, user_id)
-    send(chat_id, report_text(svc, period), MAIN_MENU)
+    finish(svc, user_id, chat_id, report_text(svc, period))
 
 
 def send_inventory(svc, chat_id):
@@ -573,28 +918,28 @@ def send_inventory(svc, chat_id):
 
 
 def send_last(svc, chat_id):
-    data = sorted(load_transactions(svc), key=lambda x: x["row"], reverse=True)[:7]
+    # Records are kept in sheet order, so the newest rows are the tail of the list.
+    data = load_transactions(svc)[-7:][::-1]
     if not data:
         send(chat_id, "ما في عمليات مسجلة", MAIN_MENU)
         return
     lines = [D, "🕐 آخر العمليات"]
     for t in data:
-        sign = "+" if t["type"] == "دخل" else "-"
-        lines.append(f"{t['date'][:10]} | {sign}{fmt(t['amount'])} | {t['item']}")
+        lines.append(f"{t['date'][:10]} | {signed(t['type'], t['amount'])} | {t['item']}")
     lines.append(D)
     send(chat_id, "\n".join(lines), MAIN_MENU)
 
 
 def undo_last(svc, chat_id, user_name):
-    data = [x for x in load_transactions(svc) if x.get("user") == user_name]
-    if not data:
+    # Row numbers are about to be used for a delete, so never trust a cached copy.
+    # Rows come back in sheet order, so the newest match is the first one seen from the end.
+    last = next((x for x in reversed(load_transactions(svc, fresh=True)) if x["user"] == user_name), None)
+    if last is None:
         send(chat_id, "ما في عملية سابقة للتراجع.", MAIN_MENU)
         return
-    last = sorted(data, key=lambda x: x["row"])[-1]
     ok = delete_transaction_row(svc, last["row"])
     if ok:
-        sign = "+" if last["type"] == "دخل" else "-"
-        send(chat_id, f"✅ تم حذف آخر عملية\n{last['item']} | {sign}{fmt(last['amount'])} درهم", MAIN_MENU)
+        send(chat_id, f"✅ تم حذف آخر عملية\n{last['item']} | {signed(last['type'], last['amount'])} درهم", MAIN_MENU)
     else:
         send(chat_id, "ما قدرت أحذف آخر عملية.", MAIN_MENU)
 
@@ -610,6 +955,13 @@ HELP = """
 • الجرد
 • التقرير
 
+أو اكتب العملية بسطر واحد، مثال:
+بعت 30 بيض 250
+اشترينا علف 1200
+
+أو اسأل عن التقرير، مثال: كم صرفنا اليوم
+أو عن المخزون، مثال: كم بيض عندنا
+
 الأوامر:
 /start أو /menu لفتح القائمة
 /cancel لإلغاء العملية الحالية
@@ -617,6 +969,57 @@ HELP = """
 """.strip()
 
 
+def process_message(chat_id, user_id, user_name, text):
+    # A warm instance keeps module state, so never let one update read another's prefetch.
+    _PREFETCHED.clear()
+    try:
+        svc = sheets_svc()
+    except Exception as e:
+        send(chat_id, f"في مشكلة بـ Google Sheets:\n{e}")
+        return
+
+    if text in ("/start", "/menu", "menu", "القائمة", "مساعدة", "/help", "help"):
+        finish(svc, user_id, chat_id, HELP if text in ("/help", "help", "مساعدة") else menu_text())
+        return
+
+    if text in CANCEL_WORDS:
+        finish(svc, user_id, chat_id, "تم إلغاء العملية.")
+        return
+
+    if text in CONFIRM_WORDS:
+        # A confirm usually saves and adjusts inventory, so read both sheets in one call.
+        ensure_state_sheet(svc)
+        if S_INVENTORY in _SHEET_IDS:
+            prefetch(svc, [f"{S_STATE}!A2:C", f"{S_INVENTORY}!A2:D"])
+    state = get_state(svc, user_id)
+    if state.get("flow") == "report":
+        handle_report_choice(svc, user_id, chat_id, text)
+        return
+    if state.get("flow"):
+        handle_flow(svc, user_id, chat_id, user_name, text, state)
+        return
+
+    action = MENU_ACTIONS.get(clean_label(text))
+    if action == "sale":
+        start_sale(svc, user_id, chat_id)
+    elif action == "purchase":
+        start_purchase(svc, user_id, chat_id)
+    elif action == "electricity":
+        start_fixed_expense(svc, user_id, chat_id, "فاتورة كهرباء")
+    elif action == "labor":
+        start_fixed_expense(svc, user_id, chat_id, "عمالة")
+    elif action == "inventory":
+        send_inventory(svc, chat_id)
+    elif action == "report":
+        advance(svc, user_id, chat_id, {"flow": "report", "step": "choose", "data": {}}, "اختر نوع التقرير:", REPORT_MENU)
+    elif action == "last":
+        send_last(svc, chat_id)
+    elif action == "undo":
+        undo_last(svc, chat_id, user_name)
+    else:
+        handle_free_text(svc, user_id, chat_id, text)
+
+
 class handler(BaseHTTPRequestHandler):
     def log_message(self, *args):
         pass
@@ -626,18 +1029,50 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b"OK")
 
+    def _reply(self, payloads):
+        # Earlier messages go out as sendMessage calls; the last one rides back in the
+        # webhook response, which Telegram executes after them. That saves one round trip.
+        if not payloads:
+            self._ok()
+            return
+        post_messages(payloads[:-1])
+        body = orjson.dumps({"method": "sendMessage", **payloads[-1]})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
         self._ok()
 
+    def _is_telegram(self):
+        if not WEBHOOK_SECRET:
+            return True  # Check disabled if env var not set
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Compare bytes: compare_digest raises TypeError on non-ASCII str input.
+        return hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode())
+
     def do_POST(self):
+        if not self._is_telegram():
+            self.send_response(401)
+            self.end_headers()
+            return
         try:
             length = int(self.headers.get("Content-Length", 0) or 0)
-            raw = self.rfile.read(length).decode("utf-8") if length else "{}"
-            update = json.loads(raw)
+            if length > MAX_UPDATE_BYTES:
+                self._ok()
+                return
+            raw = self.rfile.read(length) if length else b"{}"
+            update = orjson.loads(raw)
         except Exception:
             self._ok()
             return
 
+        if seen_update(update.get("update_id")):
+            self._ok()
+            return
+
         msg = update.get("message") or {}
         text = (msg.get("text") or "").strip()
         if not text:
@@ -647,59 +1082,17 @@ class handler(BaseHTTPRequestHandler):
         chat_id = msg.get("chat", {}).get("id")
         user_id = msg.get("from", {}).get("id")
         if user_id not in ALLOWED_USERS:
-            send(chat_id, "⛔ هذا البوت خاص")
             self._ok()
             return
 
         user_name = ALLOWED_USERS[user_id]
 
+        # Respond only once the work is done: Vercel may freeze the instance as soon as
+        # the response is complete. Redeliveries meanwhile are dropped by update_id.
+        hold_replies()
         try:
-            svc = sheets_svc()
-        except Exception as e:
-            send(chat_id, f"في مشكلة بـ Google Sheets:\n{e}")
-            self._ok()
-            return
-
-        if text in ("/start", "/menu", "menu", "القائمة", "مساعدة", "/help", "help"):
-            clear_state(svc, user_id)
-            send(chat_id, HELP if text in ("/help", "help", "مساعدة") else menu_text(), MAIN_MENU)
-            self._ok()
-            return
-
-        if text in CANCEL_WORDS:
-            clear_state(svc, user_id)
-            send(chat_id, "تم إلغاء العملية.", MAIN_MENU)
-            self._ok()
-            return
-
-        state = get_state(svc, user_id)
-        if state.get("flow") == "report":
-            handle_report_choice(svc, user_id, chat_id, text)
-            self._ok()
-            return
-        if state.get("flow"):
-            handle_flow(svc, user_id, chat_id, user_name, text, state)
-            self._ok()
-            return
-
-        if text == "💰 بيع":
-            start_sale(svc, user_id, chat_id)
-        elif text == "🛒 شراء":
-            start_purchase(svc, user_id, chat_id)
-        elif text == "⚡ فاتورة كهرباء":
-            start_fixed_expense(svc, user_id, chat_id, "فاتورة كهرباء", "كهرباء")
-        elif text == "👷 عمالة":
-            start_fixed_expense(svc, user_id, chat_id, "عمالة", "رواتب")
-        elif text == "📦 الجرد":
-            send_inventory(svc, chat_id)
-        elif text == "📊 التقرير":
-            set_state(svc, user_id, {"flow": "report", "step": "choose", "data": {}})
-            send(chat_id, "اختر نوع التقرير:", REPORT_MENU)
-        elif text == "🕐 آخر العمليات":
-            send_last(svc, chat_id)
-        elif text == "↩️ تراجع آخر عملية":
-            undo_last(svc, chat_id, user_name)
-        else:
-            send(chat_id, menu_text(), MAIN_MENU)
-
-        self._ok()
+            process_message(chat_id, user_id, user_name, text)
+        except Exception:
+            # The update is already marked seen, so a redelivery would be dropped: say so now.
+            send(chat_id, "⚠️ صار خطأ وما اكتملت العملية. حاول مرة ثانية.")
+        self._reply(take_replies())